@@ -17,38 +17,118 @@ from langgraph.graph import StateGraph, END
 from langgraph.types import Command, interrupt
 from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
 
+# Typed config passed to every graph run
+from langchain_core.runnables import RunnableConfig
+
 # LangChain tool definition decorator
 from langchain_core.tools import tool
 
 # Utility to convert LangChain tools into OpenAI-compatible schema
 from langchain_core.utils.function_calling import convert_to_openai_tool
 
+import ast
+import asyncio
+import functools
 import logging
+import math
+import operator
+import os
+import re
+import sys
+import threading
 
 
 from agent_base import ModelAdapter, AgentBase
 import agent_base
-from graph import SystemHelper, GraphState
+from graph import SystemHelper, GraphState, MessageHistory
+
+logger = logging.getLogger(__name__)
+
+# Streamed tokens are flushed to the terminal in batches of this many chunks
+STREAM_FLUSH_EVERY = 32
 
 
 # -------------------------
 # 1. TOOL DEFINITIONS
 # -------------------------
+# Largest integer (in bits) any step of a calculation may produce
+# Keeps things like '(9 ** 1000) ** 1000' from hanging the tool
+_MAX_BITS = 4096
+
+_BIN_OPS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod,
+    ast.Pow: operator.pow,
+}
+_UNARY_OPS = {
+    ast.UAdd: operator.pos,
+    ast.USub: operator.neg,
+}
+
+
+def _check_size(value):
+    # eg. '(-8) ** 0.5' is complex, the calculator only answers with real numbers
+    if isinstance(value, complex):
+        raise ValueError("Result is not a real number")
+    if isinstance(value, int) and value.bit_length() > _MAX_BITS:
+        raise ValueError(f"Result exceeds {_MAX_BITS} bits")
+    return value
+
+
+def _eval_node(node: ast.AST):
+    # Only plain arithmetic is allowed, anything else (names, calls, attributes, bools) is rejected
+    if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+        return _check_size(node.value)
+    if isinstance(node, ast.BinOp) and type(node.op) in _BIN_OPS:
+        left, right = _eval_node(node.left), _eval_node(node.right)
+        # Estimate the size of an integer power before computing it, the result check below would be too late
+        if (
+            isinstance(node.op, ast.Pow)
+            and isinstance(left, int) and isinstance(right, int)
+            and abs(left) > 1
+            # Compare huge exponents as ints first, they'd overflow the float multiply
+            and (right > _MAX_BITS or right * math.log2(abs(left)) > _MAX_BITS)
+        ):
+            raise ValueError(f"Result exceeds {_MAX_BITS} bits")
+        return _check_size(_BIN_OPS[type(node.op)](left, right))
+    if isinstance(node, ast.UnaryOp) and type(node.op) in _UNARY_OPS:
+        return _UNARY_OPS[type(node.op)](_eval_node(node.operand))
+    raise ValueError(f"Unsupported expression: {ast.dump(node)}")
+
+
+@functools.lru_cache(maxsize=1024)
+def _safe_eval(expression: str):
+    return _eval_node(ast.parse(expression, mode="eval").body)
+
+
 @tool
 def calculator(expression: str) -> str:
     """
     A basic calculator tool that evaluates mathematical expressions.
     Example input: '2 + 2', '5 * 10'
     """
-    print("🧮 Evaluating expression:", expression)
-    logging.info(f"Evaluating: {expression}")
-    return expression
+    logger.debug("🧮 Evaluating expression: %s", expression)
+    return str(_safe_eval(expression))
+
+
+# Converted schemas keyed by tool name, so re-registering a tool skips the pydantic schema walk
+_OPENAI_TOOL_CACHE: dict[str, dict] = {}
+
+
+def _to_openai(tool) -> dict:
+    if tool.name not in _OPENAI_TOOL_CACHE:
+        _OPENAI_TOOL_CACHE[tool.name] = convert_to_openai_tool(tool)
+    return _OPENAI_TOOL_CACHE[tool.name]
 
 
 # Register tools and convert them to OpenAI-compatible schema
 tools = [calculator]
 openai_tools = [
-    convert_to_openai_tool(tool) for tool in tools
+    _to_openai(tool) for tool in tools
 ]  # Needed for models that support OpenAI-style tool calling
 tool_registry = {
     tool.name: tool for tool in tools
@@ -60,35 +140,147 @@ tool_registry = {
 llm = AgentBase(ModelAdapter.mistral())
 marshall = SystemHelper(llm, tools=tool_registry)
 
+# The prompts are multi-kilobyte and never change, so build their messages once and share them
+_GENERATOR_SYS = SystemMessage(content=agent_base.WORLD_GENERATOR_PROMPT)
+_LIBRARIAN_SYS = SystemMessage(content=agent_base.WORLD_LIBRARIAN_PROMPT)
+
 
 # -------------------------
 # 6. Agent Nodes
 # TODO: Expand a bit more into defined objects
 # -------------------------
-def generator(state: GraphState) -> Command[Literal["librarian"]]:
-    state = marshall.invoke(state)
+async def generator(state: GraphState) -> Command[Literal["librarian"]]:
+    # World prompts decode thousands of tokens, so print them as they arrive instead of all at the end
+    print("🤖 Generator response: ", end="", flush=True)
+    # Only the generator is capped and stopped at the end-of-world marker, librarian answers use the model defaults
+    stream = marshall.ainvoke_stream(
+        state, max_tokens=agent_base.WORLD_MAX_TOKENS, stop=[agent_base.WORLD_END_MARKER]
+    )
+    chunks = 0
+    async for chunk in stream:
+        sys.stdout.write(chunk.content)
+        chunks += 1
+        if chunks % STREAM_FLUSH_EVERY == 0:
+            sys.stdout.flush()
+    print(flush=True)
     response = state["messages"][-1]
-    print("🤖 Generator response:", response.content)
+    if response.response_metadata.get("finish_reason") == "length":
+        logger.warning(
+            "⚠️ World hit the %s token cap before its end marker, the librarian's canon is truncated",
+            agent_base.WORLD_MAX_TOKENS,
+        )
     return Command(
         update={
-            "messages": [
-                SystemMessage(content=agent_base.WORLD_LIBRARIAN_PROMPT),
+            "messages": MessageHistory([
+                _LIBRARIAN_SYS,
                 response,
-            ]
+            ])
         },
         goto="librarian",
     )
 
 
-def librarian(state: GraphState) -> Command[Literal[END]]:
-    ask = input("What questions would you ask to test the consistency of the world rules? ")
-    print(
-        "🤖 Librarian response:",
-        marshall.invoke(
-            {"messages": state["messages"] + [HumanMessage(content=ask)]}
-        )["messages"][-1].content,
+CONSISTENCY_REVIEW = "Briefly list any internal inconsistencies or underspecified areas in the world state."
+# The review is a short list, capping it keeps it from holding a decode slot the probes could use
+REVIEW_MAX_TOKENS = 256
+
+
+# A '?' inside double quotes is part of the probe, not the end of it
+_PROBE_PATTERN = re.compile(r'(?:"[^"]*"|[^?"]|")+\?*')
+_COMMAND_PATTERN = re.compile(r"(?:^|\s)/\w")
+
+
+def split_probes(ask: str) -> list[str]:
+    # "Is X true? What about Y?" -> ["Is X true?", "What about Y?"]
+    # Commands (eg. a trailing /set) apply to everything typed with them, so that input is sent as one message
+    if _COMMAND_PATTERN.search(ask):
+        return [ask.strip()]
+    return [probe.strip() for probe in _PROBE_PATTERN.findall(ask) if probe.strip("? ")]
+
+
+def _read_line(prompt: str) -> str:
+    # Reads the raw fd rather than calling input(), a thread left blocked in input() holds sys.stdin's buffer lock
+    # and aborts interpreter shutdown
+    sys.stdout.write(prompt)
+    sys.stdout.flush()
+    data = b""
+    while b"\n" not in data:
+        chunk = os.read(sys.stdin.fileno(), 4096)
+        if not chunk:
+            if not data:
+                raise EOFError("EOF when reading a line")
+            break
+        data += chunk
+    return data.decode(sys.stdin.encoding or "utf-8").partition("\n")[0].rstrip("\r")
+
+
+async def _ainput(prompt: str) -> str:
+    # Blocking reads can't be interrupted, so read on a daemon thread and hand the line back through a future
+    # Ctrl-C cancels the await, the blocked thread is simply abandoned (asyncio.to_thread would hang shutdown joining it)
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def resolve(setter, value):
+        if not future.done():
+            setter(value)
+
+    def read():
+        try:
+            result = (future.set_result, _read_line(prompt))
+        except Exception as e:
+            result = (future.set_exception, e)
+        try:
+            loop.call_soon_threadsafe(resolve, *result)
+        except RuntimeError:
+            pass  # The loop already closed, nobody is waiting on this line anymore
+
+    threading.Thread(target=read, daemon=True).start()
+    return await future
+
+
+def _print_review(review: asyncio.Task) -> None:
+    if not review.cancelled() and review.exception() is None:
+        print("\n🤖 Librarian review:", review.result()["messages"][-1].content)
+
+
+async def librarian(state: GraphState) -> Command[Literal[END]]:
+    # Run the librarian's own consistency pass while the user is still typing
+    # This hides the round-trip + prefill under the input() wait and leaves the canon prefix warm on the server
+    review = asyncio.create_task(
+        marshall.ainvoke(
+            {"messages": MessageHistory([*state["messages"], HumanMessage(content=CONSISTENCY_REVIEW)])},
+            max_tokens=REVIEW_MAX_TOKENS,
+        )
+    )
+    # Printed as soon as it's ready, nothing else waits on it
+    review.add_done_callback(_print_review)
+    try:
+        # Keep asking until there's at least one probe, an empty answer shouldn't end up in the canon history
+        probes = []
+        while not probes:
+            # input() only ever returns a single line, so several probes are entered as several questions on it
+            ask = await _ainput(
+                "What questions would you ask to test the consistency of the world rules? "
+                "(ask several at once by ending each with '?') ",
+            )
+            probes = split_probes(ask)
+    except (asyncio.CancelledError, EOFError, KeyboardInterrupt):
+        # Under asyncio.run, Ctrl-C arrives as a cancellation of this task rather than a KeyboardInterrupt
+        review.cancel()
+        raise
+
+    # Independent probes against the same canon, one concurrent wave sharing the server's cached prefix
+    answers = await marshall.ainvoke_many([[*state["messages"], HumanMessage(content=probe)] for probe in probes])
+    response = AIMessage(
+        content="\n".join(
+            f"- {probe}\n  {answer.content}" for probe, answer in zip(probes, answers)
+        )
     )
+    print("🤖 Librarian response:\n" + response.content)
+    # The answers are already out, just don't let the run end (cancelling the review) before it's been shown
+    await asyncio.wait({review})
     return Command(
+        update={"messages": MessageHistory([*state["messages"], HumanMessage(content=ask), response])},
         goto=END,
     )
 
@@ -112,6 +304,10 @@ builder.add_edge("librarian", END)
 # Compile graph into runnable object
 graph = builder.compile()
 
+# Built once and shared by every run (and graph.abatch for generating several worlds at once)
+# The DAG is only agent -> librarian, so a low recursion limit catches any accidental loops early
+_RUN_CONFIG: RunnableConfig = {"recursion_limit": 10, "configurable": {}}
+
 
 # -------------------------
 # 8. Run the Graph
@@ -119,12 +315,13 @@ graph = builder.compile()
 if __name__ == "__main__":
     # Define conversation input
     inputs = {
-        "messages": [
-            SystemMessage(content=agent_base.WORLD_GENERATOR_PROMPT),
+        "messages": MessageHistory([
+            _GENERATOR_SYS,
             HumanMessage(content="""Wheel of Time, pre-Breaking of the World era."""),
-        ]
+        ])
     }
 
     # TODO: me - Investigate ASCII throbbers
     print("\n🚀 Running agents...\n")
-    result = graph.invoke(inputs)  # Run the compiled LangGraph DAG with input state
+    # The librarian is async, so the DAG has to be driven from an event loop
+    result = asyncio.run(graph.ainvoke(inputs, config=_RUN_CONFIG))  # Run the compiled LangGraph DAG with input state
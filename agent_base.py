@@ -1,14 +1,21 @@
+import re
 from dataclasses import dataclass
-from typing import override, List, Union
+from typing import override, List
+
+import httpx
+
+try:
+    import orjson
+except ImportError:  # Falls back to httpx's stdlib json serialization
+    orjson = None
 
 # OpenAI-compatible Chat Model (backed by local LLM endpoint like LM Studio)
 from langchain_openai import ChatOpenAI
 
-# LangChain core message types
-from langchain_core.messages import HumanMessage, AIMessage, ToolMessage, SystemMessage
+from chat_types import ChatMessage
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class ModelAdapter:
     name: str
 
@@ -16,16 +23,53 @@ class ModelAdapter:
     def mistral():
         return ModelAdapter(name="mistralai/mistral-small-3.2")
 
-ChatMessage = Union[SystemMessage, HumanMessage, AIMessage, ToolMessage]
+LOCAL_ENDPOINT = "http://127.0.0.1:1234/v1"
+
+# The generator is told to close the world with this line, generator calls pass it as a stop sequence
+WORLD_END_MARKER = "\n# END_WORLD"
+# Decode dominates local latency, so generator calls cap the world's length
+WORLD_MAX_TOKENS = 2048
+
+class _OrjsonBodyMixin:
+    # The system prompt is resent every turn, so serialize request bodies with orjson instead of stdlib json
+    def build_request(self, *args, json=None, content=None, headers=None, **kwargs):
+        if orjson is not None and json is not None and content is None:
+            content = orjson.dumps(json)
+            headers = httpx.Headers(headers)
+            headers.setdefault("Content-Type", "application/json")
+            json = None
+        return super().build_request(*args, json=json, content=content, headers=headers, **kwargs)
+
+
+class _Client(_OrjsonBodyMixin, httpx.Client):
+    pass
+
+
+class _AsyncClient(_OrjsonBodyMixin, httpx.AsyncClient):
+    pass
+
+
+# Shared keep-alive pools so every agent call reuses an open connection to the local server
+# NOTE: The async pool's sockets belong to the event loop that opened them, only drive it from one loop (agent.py's asyncio.run)
+_HTTP_LIMITS = httpx.Limits(max_keepalive_connections=16, keepalive_expiry=60.0)
+_http_client = _Client(base_url=LOCAL_ENDPOINT, http2=False, limits=_HTTP_LIMITS)
+_http_async_client = _AsyncClient(base_url=LOCAL_ENDPOINT, http2=False, limits=_HTTP_LIMITS)
+
+# NOTE: Token ids are never sent to the server, tiktoken's vocabulary doesn't match the local models'
+_TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
 
 class AgentBase(ChatOpenAI):
     def __init__(self, model_adapter: ModelAdapter):
         super().__init__(
             model=model_adapter.name,  # Local model name
-            base_url="http://127.0.0.1:1234/v1",  # Local endpoint URL
+            base_url=LOCAL_ENDPOINT,  # Local endpoint URL
+            http_client=_http_client,
+            http_async_client=_http_async_client,
             api_key="not-needed",  # Dummy API key (not used locally)
             temperature=0.2,  # Lower temperature for deterministic output
-            model_kwargs={},
+            stream_usage=True,  # Streamed responses still report token usage (the cache hit log relies on it)
+            # Let llama.cpp/LM Studio reuse the KV cache for the shared prompt prefix
+            extra_body={"cache_prompt": True},
 #     model_kwargs={
 #         "tools": openai_tools,                      # List of tools available to model
 #         "tool_choice": "auto"                       # Let model decide when to call a tool
@@ -35,8 +79,16 @@ class AgentBase(ChatOpenAI):
     # def system_prompt(self) -> str:
     #     raise NotImplementedError("This is a base class")
 
-    def call(self, messages: List[ChatMessage]):
-        return self.invoke(input=messages)
+    # Extra kwargs (eg. max_tokens, stop) are per-call overrides of the model's defaults
+    def call(self, messages: List[ChatMessage], **kwargs):
+        return self.invoke(input=messages, **kwargs)
+
+    async def acall(self, messages: List[ChatMessage], **kwargs):
+        return await self.ainvoke(input=messages, **kwargs)
+
+    def acall_stream(self, messages: List[ChatMessage], **kwargs):
+        return self.astream(input=messages, **kwargs)
+
     
 
 # Looking at https://github.com/langchain-ai/langmem and https://langchain-ai.github.io/langgraph/concepts/multi_agent/
@@ -62,6 +114,8 @@ class AgentBase(ChatOpenAI):
 #   - If the request is /finish, route to the Librarian to finalize and output the world state (ie. exit)
 
 # NOTE: The "refinement" behavior will eventually be handled by the reality manager
+# NOTE: These prompts are sent as the first (cached) system message, so they must stay byte-stable
+#   Don't interpolate anything per-turn into them or the server's prefix cache will miss every call
 # NOTE: Needs an "exit" clause
 WORLD_GENERATOR_PROMPT = """
 Role:
@@ -80,6 +134,7 @@ If the user does not invoke refinement, treat your output as final canon.
 Output Style:
 Present the world in a structured, reference-style overview, organized for clarity and factual inquiry. Avoid improvisation or thematic interpretation; focus on verifiable, canonical details.
 If the base is historical or real-world, stick to factual accuracy unless explicitly told otherwise.
+When the world is complete, end your output with a line containing only "# END_WORLD".
 
 Refinement Behaviors:
 When the user requests adjustments to the relative importance of any feature within the world model, rebalance that feature instead of exaggerating or erasing it. Preserve its presence at the adjusted level of significance. Importance can be scaled globally or within specific domains (e.g., spiritual, political, ecological, cultural), according to the user’s instructions.
@@ -151,4 +206,15 @@ You are the World Librarian. You are the final custodian of a locked fictional w
 - Be conversational and collaborative, like a co-writer helping to research an imaginative world.
 - Offer clarifications and suggest refinements when inconsistencies are spotted.
 - Treat canon as inflexible unless /set or /force is used.
-"""
\ No newline at end of file
+"""
+
+# The byte-stable prompts are counted once at load, everything else is counted fresh so trimmed messages aren't kept alive
+_PROMPT_TOKEN_COUNTS = {p: len(_TOKEN_PATTERN.findall(p)) for p in (WORLD_GENERATOR_PROMPT, WORLD_LIBRARIAN_PROMPT)}
+
+
+def count_tokens(message: ChatMessage) -> int:
+    # Rough local estimate (words + punctuation), ChatOpenAI.get_num_tokens would download tiktoken's BPE
+    # files on first use and the local models don't share its vocabulary anyway
+    content = str(message.content)
+    count = _PROMPT_TOKEN_COUNTS.get(content)
+    return count if count is not None else len(_TOKEN_PATTERN.findall(content))
@@ -0,0 +1,5 @@
+# LangChain core message types
+from langchain_core.messages import HumanMessage, AIMessage, ToolMessage, SystemMessage
+
+# Every message kind that can appear in a conversation/GraphState
+ChatMessage = SystemMessage | HumanMessage | AIMessage | ToolMessage
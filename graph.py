@@ -1,67 +1,267 @@
-from typing import Annotated, TypedDict, List, Union
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict, deque
+from operator import itemgetter
+from typing import Annotated, Iterable, TypedDict, List
 
 # LangChain core message types
-from langchain_core.messages import HumanMessage, AIMessage, ToolMessage, SystemMessage
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage, SystemMessage, message_chunk_to_message
 
-from agent_base import AgentBase
+from agent_base import AgentBase, count_tokens
+from chat_types import ChatMessage
+
+logger = logging.getLogger(__name__)
+
+_tool_call_fields = itemgetter("name", "args", "id")
 
 # -------------------------
 # 3. LangGraph Shared State Definition
 # -------------------------
-AiMessage = Union[SystemMessage, HumanMessage, AIMessage, ToolMessage]
+class MessageHistory(deque):
+    # A deque of messages that keeps a running (estimated) token total, so trimming never re-counts the history
+    # Every mutating deque method below keeps .tokens in sync
+    def __init__(self, messages: Iterable[ChatMessage]=()):
+        super().__init__(messages)
+        self.tokens = sum(count_tokens(m) for m in self)
+
+    def append(self, message: ChatMessage) -> None:
+        super().append(message)
+        self.tokens += count_tokens(message)
+
+    def appendleft(self, message: ChatMessage) -> None:
+        super().appendleft(message)
+        self.tokens += count_tokens(message)
+
+    def extend(self, messages: Iterable[ChatMessage]) -> None:
+        messages = list(messages)
+        super().extend(messages)
+        self.tokens += sum(count_tokens(m) for m in messages)
+
+    def extendleft(self, messages: Iterable[ChatMessage]) -> None:
+        messages = list(messages)
+        super().extendleft(messages)
+        self.tokens += sum(count_tokens(m) for m in messages)
+
+    def insert(self, index: int, message: ChatMessage) -> None:
+        super().insert(index, message)
+        self.tokens += count_tokens(message)
+
+    def pop(self) -> ChatMessage:
+        message = super().pop()
+        self.tokens -= count_tokens(message)
+        return message
+
+    def popleft(self) -> ChatMessage:
+        message = super().popleft()
+        self.tokens -= count_tokens(message)
+        return message
+
+    def remove(self, message: ChatMessage) -> None:
+        super().remove(message)
+        self.tokens -= count_tokens(message)
+
+    def clear(self) -> None:
+        super().clear()
+        self.tokens = 0
+
+    def __setitem__(self, index: int, message: ChatMessage) -> None:
+        self.tokens += count_tokens(message) - count_tokens(self[index])
+        super().__setitem__(index, message)
+
+    def __delitem__(self, index: int) -> None:
+        self.tokens -= count_tokens(self[index])
+        super().__delitem__(index)
+
+    def __iadd__(self, messages: Iterable[ChatMessage]) -> "MessageHistory":
+        self.extend(messages)
+        return self
+
+
 class GraphState(TypedDict):
     # Shared state for LangGraph. Tracks all messages in the conversation.
-    messages: Annotated[List[AiMessage], "messages"]
+    # A deque so the oldest turns can be dropped in O(1) once the context budget is exceeded
+    # NOTE: SystemHelper appends/trims this in place, copy it first if the caller needs the original
+    messages: Annotated[MessageHistory, "messages"]
 
 
 # Not sure if I want this to be a consistent part of the system or just an initial setup helper
 class SystemHelper:
-    def __init__(self, llm: AgentBase, tools: dict=None):
+    def __init__(self, llm: AgentBase, tools: dict=None, max_cache_size: int=512, max_context_tokens: int=8192):
         self._llm = llm
-        self._tool_registry = tools if tools else {}
+        # Pre-bound invoke methods so tool dispatch is a single dict lookup
+        self._tool_invokers = {name: tool.invoke for name, tool in (tools or {}).items()}
 
-    def _call_agent(self, messages: List[AiMessage]) -> None:
-        return self._llm.call(messages)
+        # Exact-match LRU of previously answered conversations (resubmits, repeated queries)
+        self._cache: OrderedDict[str, AIMessage] = OrderedDict()
+        self._max_cache_size = max_cache_size
+        # Measured with the local count_tokens estimate, not the model's tokenizer, so leave some headroom
+        self._max_context_tokens = max_context_tokens
 
-    def _call_tool(self, tool_name: str, tool_args: dict, call_id: str) -> None:
-        # Validate tool existence
-        if tool_name not in self._tool_registry:
-            raise NameError(f"⚠️ Tool {tool_name} not found in registry")
+        # The llm never changes after construction, so SystemHelper.invoke is built around its bound call
+        self.invoke = self._make_invoke(llm.call)
+
+    @staticmethod
+    def _cache_key(messages: List[ChatMessage], call_kwargs: dict) -> str:
+        # Per-call overrides change the answer (eg. stop/max_tokens), so they're part of the key
+        # Tool calls/ids are part of the conversation too, two AI messages differing only in their calls aren't equal
+        parts = [
+            f"{m.type}:{m.content}:{getattr(m, 'tool_calls', None)!r}:{getattr(m, 'tool_call_id', None)}".encode()
+            for m in messages
+        ]
+        parts.append(repr(sorted(call_kwargs.items())).encode())
+        return hashlib.blake2b(b"\0".join(parts), digest_size=16).hexdigest()
+
+    def _cache_store(self, key: str, response: AIMessage) -> None:
+        self._cache[key] = response
+        self._cache.move_to_end(key)
+        if len(self._cache) > self._max_cache_size:
+            self._cache.popitem(last=False)
+
+    def _trim(self, state: GraphState, max_tokens: int) -> GraphState:
+        # Drop the oldest user/assistant turns until the conversation fits
+        # The system prompt, everything up to the first AI reply (the world canon) and the latest turn are always
+        # kept, everything else depends on them
+        messages = state["messages"]
+        if not isinstance(messages, MessageHistory):
+            messages = state["messages"] = MessageHistory(messages)
+
+        if messages.tokens <= max_tokens:
+            return state
 
-        # Invoke the tool using registered function
-        output = self._tool_registry[tool_name].invoke(tool_args)
+        pinned = []
+        if messages and isinstance(messages[0], SystemMessage):
+            pinned.append(messages.popleft())
+        if any(isinstance(m, AIMessage) for m in messages):
+            while not isinstance(messages[0], AIMessage):
+                pinned.append(messages.popleft())
+        if messages:
+            pinned.append(messages.popleft())
+        pinned_tokens = sum(count_tokens(m) for m in pinned)
+        try:
+            while messages.tokens + pinned_tokens > max_tokens:
+                # A turn is a HumanMessage plus the replies/tool results after it, never split one so roles keep
+                # alternating. The last turn is never dropped, it's what's being answered
+                turn = [messages.popleft()] if messages else []
+                while messages and not isinstance(messages[0], HumanMessage):
+                    turn.append(messages.popleft())
+                if not messages:
+                    messages.extend(turn)
+                    break
+        finally:
+            messages.extendleft(reversed(pinned))
+
+        if messages.tokens > max_tokens:
+            logger.warning("⚠️ Conversation is still ~%s tokens after trimming", messages.tokens)
+        return state
+
+    def _call_tool(self, tool_name: str, tool_args: dict, call_id: str) -> None:
+        # Unknown tools raise KeyError here, reported by invoke_tool
+        output = self._tool_invokers[tool_name](tool_args)
         return [ToolMessage(tool_call_id=call_id, content=str(output))]
 
-    # TODO: me - this has to be the api because that's what the graph expects
-    def invoke(self, state: GraphState) -> GraphState:
+    def _cache_lookup(self, key: str) -> AIMessage:
+        response = self._cache.get(key)
+        if response is not None:
+            self._cache.move_to_end(key)
+            usage = response.usage_metadata or {}
+            logger.debug("🟢 cache hit, saved %s tokens", usage.get("total_tokens", 0))
+            # Every history gets its own copy, the cached instance is never shared between conversations
+            response = response.model_copy()
+        return response
+
+    def _prepare(self, state: GraphState, cache: bool, call_kwargs: dict) -> tuple[str, AIMessage]:
+        # Shared start of every agent call, returns the cache key (None if bypassed) and any cached response
+        self._trim(state, self._max_context_tokens)
+        if not cache:
+            return None, None
+        key = self._cache_key(state["messages"], call_kwargs)
+        return key, self._cache_lookup(key)
+
+    def _record(self, state: GraphState, key: str, response: AIMessage) -> GraphState:
+        state["messages"].append(response)
+        if key is not None:
+            self._cache_store(key, response)
+        return state
+
+    def _record_failure(self, state: GraphState, e: Exception) -> GraphState:
+        logger.error("❌ Agent invocation failed: %s", e)
+        state["messages"].append(AIMessage(content=str(e)))
+        return state
+
+    def _make_invoke(self, call):
+        # Specialized once per instance, the bound llm.call and helpers are captured instead of looked up each turn
+        prepare, record, record_failure = self._prepare, self._record, self._record_failure
+
+        # TODO: me - this has to be the api because that's what the graph expects
+        def invoke(state: GraphState, cache: bool=True, **kwargs) -> GraphState:
+            try:
+                key, response = prepare(state, cache, kwargs)
+                if response is None:
+                    response = call(state["messages"], **kwargs)
+                return record(state, key, response)
+            except Exception as e:
+                return record_failure(state, e)
+
+        return invoke
+
+    async def ainvoke(self, state: GraphState, cache: bool=True, **kwargs) -> GraphState:
         try:
-            response = self._call_agent(state["messages"])
-            state["messages"] = state["messages"] + [response]
+            key, response = self._prepare(state, cache, kwargs)
+            if response is None:
+                response = await self._llm.acall(state["messages"], **kwargs)
+            return self._record(state, key, response)
         except Exception as e:
-            print(f"❌ Agent invocation failed: {str(e)}")
-            state["messages"] = state["messages"] + [AIMessage(content=str(e))]
-        return state
-    
+            return self._record_failure(state, e)
+
+    async def ainvoke_stream(self, state: GraphState, cache: bool=True, **kwargs):
+        # Yields chunks as the server decodes them, the full response is appended once the stream ends
+        # Async so cancelling the awaiting task (eg. Ctrl-C under asyncio.run) stops the stream between chunks
+        try:
+            key, response = self._prepare(state, cache, kwargs)
+            if response is None:
+                full = None
+                async for chunk in self._llm.acall_stream(state["messages"], **kwargs):
+                    # Merge the chunks themselves so tool calls, metadata and usage survive, not just the text
+                    full = chunk if full is None else full + chunk
+                    yield chunk
+                if full is None:
+                    raise ValueError("Agent returned an empty stream")
+                response = message_chunk_to_message(full)
+            else:
+                yield response
+            self._record(state, key, response)
+        except Exception as e:
+            self._record_failure(state, e)
+
+    async def ainvoke_many(self, batch: List[List[ChatMessage]]) -> List[AIMessage]:
+        # Fire every conversation in one wave so the server can batch them together
+        # Each goes through ainvoke, so it's still trimmed and a repeated conversation is served from the cache
+        states = [{"messages": MessageHistory(messages)} for messages in batch]
+        await asyncio.gather(*[self.ainvoke(state) for state in states])
+        return [state["messages"][-1] for state in states]
+
     def invoke_tool(self, state: GraphState) -> GraphState:
         messages = state["messages"]
         last_msg = messages[-1]  # Get last AI message that might have a tool call
 
-        if not hasattr(last_msg, 'tool_calls') or not last_msg.tool_calls:
-            print("⚠️ No tool calls in last message")
+        tool_calls = getattr(last_msg, "tool_calls", None)
+        if not tool_calls:
+            logger.warning("⚠️ No tool calls in last message")
             return {"messages": messages}
 
         # Extract first tool call from AIMessage
-        tool_call = last_msg.tool_calls[0]
-        name = tool_call.get("name")
-        args = tool_call.get("args", {})
-        call_id = tool_call.get("id")
+        name, args, call_id = _tool_call_fields(tool_calls[0])
 
         try:
             response = self._call_tool(name, args, call_id)
-            state["messages"] = state["messages"] + response
+            state["messages"].extend(response)
 
         except Exception as e:
-            print(f"❌ Tool invocation failed: {str(e)}")
-            state["messages"] = state["messages"] + [AIMessage(content=str(e))]
+            error = str(e)
+            if isinstance(e, KeyError) and name not in self._tool_invokers:
+                error = f"Tool {name} not found in registry"
+            logger.error("❌ Tool invocation failed: %s", error)
+            state["messages"].append(AIMessage(content=error))
 
-        return state
\ No newline at end of file
+        return state